@@ -1,10 +1,27 @@
+import argparse
+import contextlib
+import inspect
+import json
 import multiprocessing as mp
+import os
+import shutil
+import sys
 import numpy as np
 import itertools
 import pandas as pd
 from pathlib import Path
 
+from src.calc import tech_graph
+from src.calc.param_set import ParamSet
+from src.calc.tech_class import Tech
 from tools import process_tech_df
+from tools import rawdata
+from tools import result_cache
+
+PATH_TO_PARAMS = str(Path(__file__).parent / 'src/calc/params.json')
+
+# maximum number of grid points per chunk: bounds the memory used by the chunks being calculated and written
+MAX_CHUNK_POINTS = 2000
 
 
 def mainfig_params():
@@ -26,65 +43,48 @@ def sup_params():
     params = itertools.product(*param_dict.values())
     return (param_dict, params)
 
-def mainfig_calc_dfs(param_set, param_dict):
-    temp_dict = dict(zip(param_dict.keys(), param_set))
-    load_json = True
-
-    df_normal = process_tech_df.get_df(scenario = "normal", load_json = load_json, **temp_dict)
-    df_ccu = process_tech_df.get_df(scenario = "ccu", CCU_coupling=True, DACCS = True, compensate=False, load_json= load_json, **temp_dict)
-    df_comp = process_tech_df.get_df(scenario = "comp", CCU_coupling=True, DACCS=False, compensate=True, load_json=load_json, **temp_dict)
+def mainfig_scenarios():
+    return [
+        dict(scenario = "normal"),
+        dict(scenario = "ccu", CCU_coupling=True, DACCS = True, compensate=False),
+        dict(scenario = "comp", CCU_coupling=True, DACCS=False, compensate=True),
+    ]
 
-    return [df_normal, df_ccu, df_comp]
+def sup_scenarios():
+    return [dict()]
 
-def sup_calc_dfs(param_set, param_dict):
-    temp_dict = dict(zip(param_dict.keys(), param_set))
-    df = process_tech_df.get_df(**temp_dict)
-    return df
-
-def sup2_calc_dfs(param_set, param_dict):
-    temp_dict = dict(zip(param_dict.keys(), param_set))
+def sup2_scenarios():
     retrofitted_techs = ["ccs_steel", "ccu_steel", "comp_steel", "ccs_cement", "ccu_cement", "comp_cement", "comp_chem"] 
 
-    df_greenfield = process_tech_df.get_df(scenario = "greenfield", **temp_dict)
-    df_brownfield = process_tech_df.get_df(scenario="brownfield", retrofit=True, retrofit_techs = retrofitted_techs, **temp_dict)
-    df_greenfieldcomp = process_tech_df.get_df(scenario = "greenfield_comp", compensate=True, **temp_dict)
-    df_brownfieldcomp = process_tech_df.get_df(scenario="brownfield_comp", compensate=True, retrofit=True, retrofit_techs = retrofitted_techs, **temp_dict)
-
-    return [df_greenfield, df_brownfield, df_greenfieldcomp, df_brownfieldcomp]
+    return [
+        dict(scenario = "greenfield"),
+        dict(scenario="brownfield", retrofit=True, retrofit_techs = retrofitted_techs),
+        dict(scenario = "greenfield_comp", compensate=True),
+        dict(scenario="brownfield_comp", compensate=True, retrofit=True, retrofit_techs = retrofitted_techs),
+    ]
 
-def sup3_calc_dfs(param_set, param_dict):
+def sup3_scenarios():
     #bfccs sensitivity (+/- 50% on CCS capex)
-    temp_dict = dict(zip(param_dict.keys(), param_set))
-    load_json = True
-
-    df_normal = process_tech_df.get_df(scenario = "normal", load_json = load_json, **temp_dict)
-    df_lowCCS = process_tech_df.get_df(scenario = "lowCCS", load_json = load_json,ccs_steel_capex = 782.5, **temp_dict)
-    df_highCCS = process_tech_df.get_df(scenario = "highCCS", load_json = load_json,ccs_steel_capex = 978.7, **temp_dict)
-    df_normalcomp = process_tech_df.get_df(scenario = "normal_comp", DACCS=False, compensate=True, load_json = load_json, **temp_dict)
-    df_lowCCScomp = process_tech_df.get_df(scenario = "lowCCS_comp", DACCS=False, compensate=True, load_json = load_json,ccs_steel_capex = 782.5, **temp_dict)
-    df_highCCScomp = process_tech_df.get_df(scenario = "highCCS_comp", DACCS=False, compensate=True, load_json = load_json,ccs_steel_capex = 978.7, **temp_dict)
-    
-
-    return [df_normal, df_lowCCS, df_highCCS, df_normalcomp, df_lowCCScomp, df_highCCScomp]
-
-def sup4_calc_dfs(param_set, param_dict):
+    return [
+        dict(scenario = "normal"),
+        dict(scenario = "lowCCS", ccs_steel_capex = 782.5),
+        dict(scenario = "highCCS", ccs_steel_capex = 978.7),
+        dict(scenario = "normal_comp", DACCS=False, compensate=True),
+        dict(scenario = "lowCCS_comp", DACCS=False, compensate=True, ccs_steel_capex = 782.5),
+        dict(scenario = "highCCS_comp", DACCS=False, compensate=True, ccs_steel_capex = 978.7),
+    ]
+
+def sup4_scenarios():
     #aviation fossil cost sensitivity (varying fossil kerosene cost)
-    temp_dict = dict(zip(param_dict.keys(), param_set))
-    load_json = True
-
-    df_normal = process_tech_df.get_df(scenario = "normal", load_json = load_json, **temp_dict)
-    df_lowfossilJ = process_tech_df.get_df(scenario = "lowfossilJ", load_json = load_json,fossilJ_LCO = 25, **temp_dict)
-    df_highfossilJ = process_tech_df.get_df(scenario = "highfossilJ", load_json = load_json,fossilJ_LCO = 75, **temp_dict)
-    
-
-    return [df_normal, df_lowfossilJ, df_highfossilJ]
+    return [
+        dict(scenario = "normal"),
+        dict(scenario = "lowfossilJ", fossilJ_LCO = 25),
+        dict(scenario = "highfossilJ", fossilJ_LCO = 75),
+    ]
 
-def sup5_calc_dfs(param_set, param_dict):
+def sup5_scenarios():
     #blue hydrogen sensitivity (add technologies)
     #and add blue steel emissions based on methane leakage
-    temp_dict = dict(zip(param_dict.keys(), param_set))
-    load_json = True
-
     inexistant_techs = [
             "ccs_plane",
             "h2_plane",
@@ -106,83 +106,580 @@ def sup5_calc_dfs(param_set, param_dict):
     low_leakage_emgwp20 = 0.001*(1/NG_lhv)*GWP20
     high_leakage_emgwp20 = 0.03*(1/NG_lhv)*GWP20
 
-    df_normal = process_tech_df.get_df(scenario = "noleakage", load_json = load_json, inexistant_techs = inexistant_techs, blueh2_co2em = 0, **temp_dict)
-    df_lowleakage = process_tech_df.get_df(scenario = "lowleakage", load_json = load_json,inexistant_techs = inexistant_techs, blueh2_co2em = low_leakage_emgwp100, **temp_dict)
-    df_highleakage = process_tech_df.get_df(scenario = "highleakage", load_json = load_json,inexistant_techs = inexistant_techs,blueh2_co2em = high_leakage_emgwp100, **temp_dict)
-    df_normalcomp = process_tech_df.get_df(scenario = "noleakage_compgwp100", load_json = load_json, compensate=True, inexistant_techs = inexistant_techs, blueh2_co2em = 0, **temp_dict)
-    df_lowleakagecomp = process_tech_df.get_df(scenario = "lowleakage_compgwp100", load_json = load_json, compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = low_leakage_emgwp100, **temp_dict)
-    df_highleakagecomp = process_tech_df.get_df(scenario = "highleakage_compgwp100", load_json = load_json, compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = high_leakage_emgwp100, **temp_dict)
-    df_normalcomp20 = process_tech_df.get_df(scenario = "noleakage_compgwp20", load_json = load_json, compensate=True, inexistant_techs = inexistant_techs, blueh2_co2em = 0, **temp_dict)
-    df_lowleakagecomp20 = process_tech_df.get_df(scenario = "lowleakage_compgwp20", load_json = load_json, compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = low_leakage_emgwp20, **temp_dict)
-    df_highleakagecomp20 = process_tech_df.get_df(scenario = "highleakage_compgwp20", load_json = load_json, compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = high_leakage_emgwp20, **temp_dict)
-    
-
-    return [df_normal, df_lowleakage, df_highleakage, df_normalcomp, df_lowleakagecomp, df_highleakagecomp, df_normalcomp20, df_lowleakagecomp20, df_highleakagecomp20]
-
-def sup6_calc_dfs(param_set, param_dict):
-    temp_dict = dict(zip(param_dict.keys(), param_set))
-    load_json = True
-
-    df_normal = process_tech_df.get_df(scenario = "normal", load_json = load_json, co2ccu_co2em = 0.85, **temp_dict)
-    df_ccu = process_tech_df.get_df(scenario = "ccu", CCU_coupling=True, DACCS = True, compensate=False, load_json= load_json, co2ccu_co2em = 0.85, **temp_dict)
-    df_comp = process_tech_df.get_df(scenario = "comp", CCU_coupling=True, DACCS=False, compensate=True, load_json=load_json, co2ccu_co2em = 0.85, **temp_dict)
-
-    return [df_normal, df_ccu, df_comp]
-
-def save_mainfigdata(mainfig_list_of_dfs):
-    list_of_dfs = [df for sublist in mainfig_list_of_dfs for df in sublist]  # Flatten the list
-    df_final = pd.concat(list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/mainfig_rawdata.csv'))
-
-def save_supdata(sup_list_of_dfs):
-    df_final = pd.concat(sup_list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/sup_rawdata.csv'))
-
-def save_sup2data(sup2_list_of_dfs):
-    list_of_dfs = [df for sublist in sup2_list_of_dfs for df in sublist]  # Flatten the list
-    df_final = pd.concat(list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/supretrofit_rawdata.csv'))
-
-def save_sup3data(sup3_list_of_dfs):
-    list_of_dfs = [df for sublist in sup3_list_of_dfs for df in sublist]  # Flatten the list
-    df_final = pd.concat(list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/supBFCCS_rawdata.csv'))
-
-def save_sup4data(sub4_list_of_dfs):
-    list_of_dfs = [df for sublist in sub4_list_of_dfs for df in sublist]  # Flatten the list
-    df_final = pd.concat(list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/supfossilcost_rawdata.csv'))
-
-def save_sup5data(sub5_list_of_dfs):
-    list_of_dfs = [df for sublist in sub5_list_of_dfs for df in sublist]  # Flatten the list
-    df_final = pd.concat(list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/supblueh2_rawdata.csv'))
-
-def save_sup6data(sub6_list_of_dfs):
-    list_of_dfs = [df for sublist in sub6_list_of_dfs for df in sublist]  # Flatten the list
-    df_final = pd.concat(list_of_dfs, ignore_index=True)
-    df_final.to_csv(str(Path(__file__).parent / 'data/supCCUattrib_rawdata.csv'))
+    return [
+        dict(scenario = "noleakage", inexistant_techs = inexistant_techs, blueh2_co2em = 0),
+        dict(scenario = "lowleakage", inexistant_techs = inexistant_techs, blueh2_co2em = low_leakage_emgwp100),
+        dict(scenario = "highleakage", inexistant_techs = inexistant_techs,blueh2_co2em = high_leakage_emgwp100),
+        dict(scenario = "noleakage_compgwp100", compensate=True, inexistant_techs = inexistant_techs, blueh2_co2em = 0),
+        dict(scenario = "lowleakage_compgwp100", compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = low_leakage_emgwp100),
+        dict(scenario = "highleakage_compgwp100", compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = high_leakage_emgwp100),
+        dict(scenario = "noleakage_compgwp20", compensate=True, inexistant_techs = inexistant_techs, blueh2_co2em = 0),
+        dict(scenario = "lowleakage_compgwp20", compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = low_leakage_emgwp20),
+        dict(scenario = "highleakage_compgwp20", compensate=True,inexistant_techs = inexistant_techs,blueh2_co2em = high_leakage_emgwp20),
+    ]
+
+def sup6_scenarios():
+    return [
+        dict(scenario = "normal", co2ccu_co2em = 0.85),
+        dict(scenario = "ccu", CCU_coupling=True, DACCS = True, compensate=False, co2ccu_co2em = 0.85),
+        dict(scenario = "comp", CCU_coupling=True, DACCS=False, compensate=True, co2ccu_co2em = 0.85),
+    ]
+
+def hm_families():
+    """
+    Returns the heat map data families: output file, grid parameters and scenarios (get_df kwargs) of each.
+    """
+    return {
+        "mainfig": ("mainfig_rawdata.csv", mainfig_params, mainfig_scenarios),
+        "sup": ("sup_rawdata.csv", sup_params, sup_scenarios),
+        "sup2": ("supretrofit_rawdata.csv", mainfig_params, sup2_scenarios),
+        "sup3": ("supBFCCS_rawdata.csv", mainfig_params, sup3_scenarios),
+        "sup4": ("supfossilcost_rawdata.csv", mainfig_params, sup4_scenarios),
+        "sup5": ("supblueh2_rawdata.csv", mainfig_params, sup5_scenarios),
+        "sup6": ("supCCUattrib_rawdata.csv", mainfig_params, sup6_scenarios),
+    }
 
-if __name__ == "__main__":
-    # calculates data for 3 heatmap figures: the main figure, supplementary figure with CO2 transport and storage sensitivity,
-    # and supplementary with retrofit sensitivity
-    
-    #multiprocessing to speed up hm data calculation
-    with mp.Pool(mp.cpu_count()) as pool:
-        mainfig_list_of_dfs = pool.starmap(mainfig_calc_dfs, [(param_set, mainfig_params()[0]) for param_set in mainfig_params()[1]])
-        sup_list_of_dfs = pool.starmap(sup_calc_dfs, [(param_set, sup_params()[0]) for param_set in sup_params()[1]])
-        sup2_list_of_dfs = pool.starmap(sup2_calc_dfs, [(param_set, mainfig_params()[0]) for param_set in mainfig_params()[1]])
-        sup3_list_of_dfs = pool.starmap(sup3_calc_dfs, [(param_set, mainfig_params()[0]) for param_set in mainfig_params()[1]])
-        sup4_list_of_dfs = pool.starmap(sup4_calc_dfs, [(param_set, mainfig_params()[0]) for param_set in mainfig_params()[1]])
-        sup5_list_of_dfs = pool.starmap(sup5_calc_dfs, [(param_set, mainfig_params()[0]) for param_set in mainfig_params()[1]])
-        sup6_list_of_dfs = pool.starmap(sup6_calc_dfs, [(param_set, mainfig_params()[0]) for param_set in mainfig_params()[1]])
-
-    save_mainfigdata(mainfig_list_of_dfs)
-    save_supdata(sup_list_of_dfs)
-    save_sup2data(sup2_list_of_dfs)
-    save_sup3data(sup3_list_of_dfs)
-    save_sup4data(sup4_list_of_dfs)
-    save_sup5data(sup5_list_of_dfs)
-    save_sup6data(sup6_list_of_dfs)
+# chunked calculations, for the multiprocessing pool
+def split_grid(param_dict, n_chunks):
+    """
+    Splits the grid into (at most) n_chunks contiguous chunks, along its first parameter.
+    Concatenating the chunks in order gives back the itertools.product order of the full grid.
+    """
+    first_key = next(iter(param_dict))
+    splits = np.array_split(np.asarray(param_dict[first_key]), n_chunks)
+    return [{**param_dict, first_key: values} for values in splits if len(values) > 0]
+
+def grid_index(df, param_dict):
+    """Returns the index of the grid point (in itertools.product order) of each row of df."""
+    positions = [pd.Index(values).get_indexer(df[key]) for key, values in param_dict.items()]
+    return np.ravel_multi_index(positions, [len(values) for values in param_dict.values()])
+
+# cache of the results of each worker, and the part of the cache keys common to all results (see init_worker)
+worker_cache = None
+worker_key_base = None
+
+def init_worker(path_to_params, cache_dir=None, cache_size=result_cache.DEFAULT_MAX_SIZE):
+    global worker_cache, worker_key_base
+    # parse the params file and compile the tech dependencies once per worker
+    ParamSet.from_file(path_to_params).plan
+    if cache_dir is not None:
+        worker_cache = result_cache.ResultCache(cache_dir, cache_size)
+        worker_key_base = (result_cache.params_fingerprint(path_to_params), result_cache.code_version())
+
+def config_key(kwargs):
+    """
+    Key identifying a get_df configuration: the kwargs without the scenario name, with the get_df defaults filled in.
+    Scenarios with the same key give the same results, up to their name.
+    """
+    defaults = {
+        name: param.default
+        for name, param in inspect.signature(process_tech_df.get_df_batch).parameters.items()
+        if param.default is not inspect.Parameter.empty and name not in ["scenario", "as_cube", "breakdown", "param_set", "sectors"]
+    }
+    config = {**defaults, **{k: v for k, v in kwargs.items() if k != "scenario"}}
+    return json.dumps(config, sort_keys=True, default=list)
+
+def grid_key(param_dict):
+    """Key identifying a grid of parameters."""
+    return json.dumps({k: np.asarray(v).tolist() for k, v in param_dict.items()})
+
+def distinct_configs(families):
+    """
+    Registry of the configurations needed by the families, grouped by grid.
+    Returns a dict: grid key -> (grid parameters, family names, {config key: get_df kwargs}),
+    where each distinct configuration appears once, even if several families (or scenarios) declare it.
+    """
+    registry = {}
+    for name, (file_name, params, scenarios) in families.items():
+        param_dict = params()[0]
+        _, names, configs = registry.setdefault(grid_key(param_dict), (param_dict, [], {}))
+        names.append(name)
+        for kwargs in scenarios():
+            configs.setdefault(config_key(kwargs), {k: v for k, v in kwargs.items() if k != "scenario"})
+    return registry
+
+def calc_config(param_grid, kwargs):
+    """
+    Calculates a configuration (get_df kwargs) for a chunk of the grid.
+    With a cache, the results are stored per line of the grid (value of its first parameter), keyed on the params file,
+    the configuration, the line and the code version: only the lines missing from the cache are calculated.
+    """
+    if worker_cache is None:
+        return process_tech_df.get_df_batch(param_grid, **kwargs)
+
+    first_key = next(iter(param_grid))
+    line_keys = {
+        value: result_cache.make_key(*worker_key_base, config_key(kwargs), grid_key({**param_grid, first_key: [value]}))
+        for value in param_grid[first_key]
+    }
+    dfs = {value: worker_cache.get(key) for value, key in line_keys.items()}
+
+    missing = [value for value, df in dfs.items() if df is None]
+    if missing:
+        df_missing = process_tech_df.get_df_batch({**param_grid, first_key: missing}, **kwargs)
+        for value in missing:
+            dfs[value] = df_missing[df_missing[first_key] == value]
+            worker_cache.put(line_keys[value], dfs[value])
+
+    return pd.concat(dfs.values(), ignore_index=True)
+
+def calc_chunk(param_grid, configs):
+    """Calculates each configuration (get_df kwargs) for a chunk of the grid."""
+    return [rawdata.df_to_arrays(calc_config(param_grid, kwargs)) for kwargs in configs]
+
+def calc_numbered_chunk(task):
+    """calc_chunk for a task (chunk number, chunk of the grid, configurations) of imap_unordered. Returns the chunk number too."""
+    idx, param_grid, configs = task
+    return idx, calc_chunk(param_grid, configs)
+
+def chunk_key(chunk, configs):
+    """Key of the results of configurations (config key -> get_df kwargs) for a chunk of a grid, in the checkpoints."""
+    return result_cache.make_key(grid_key(chunk), [config_key(kwargs) for kwargs in configs.values()])
+
+def calc_configs(pool, param_dict, configs, n_chunks, checkpoints=None):
+    """
+    Calculates configurations (config key -> get_df kwargs) over a grid, with the chunks of the grid spread over the pool.
+    Yields (chunk of the grid, {config key: DataFrame}) for each chunk, in the order of the grid: each chunk is yielded
+    as soon as it and the chunks before it are done, so that only the chunks finished out of order are held in memory.
+    With checkpoints (see open_checkpoints), the results of each chunk are stored as soon as they are calculated,
+    and the chunks stored by an interrupted run are not calculated again.
+    """
+    chunks = split_grid(param_dict, n_chunks)
+    if not configs:
+        for chunk in chunks:
+            yield chunk, {}
+        return
+
+    done = {}
+    if checkpoints is not None:
+        for idx, chunk in enumerate(chunks):
+            arrays = checkpoints.get(chunk_key(chunk, configs))
+            if arrays is not None:
+                done[idx] = arrays
+
+    tasks = [(idx, chunk, list(configs.values())) for idx, chunk in enumerate(chunks) if idx not in done]
+    results = pool.imap_unordered(calc_numbered_chunk, tasks) if tasks else iter([])
+    next_idx = 0
+    while next_idx < len(chunks):
+        if next_idx not in done:
+            idx, arrays = next(results)
+            if checkpoints is not None:
+                checkpoints.put(chunk_key(chunks[idx], configs), arrays)
+            done[idx] = arrays
+            continue
+        arrays = done.pop(next_idx)
+        yield chunks[next_idx], {key: rawdata.arrays_to_df(arrays[i]) for i, key in enumerate(configs.keys())}
+        next_idx += 1
+
+def chunk_count(param_dict, n_workers):
+    """Returns the number of chunks of a grid: at least one per worker, and at most MAX_CHUNK_POINTS grid points per chunk."""
+    n_points = np.prod([len(values) for values in param_dict.values()])
+    return max(n_workers, int(np.ceil(n_points / MAX_CHUNK_POINTS)))
+
+def assemble_family(param_dict, scenarios, config_dfs):
+    """
+    Assembles the data of a family from the results of each configuration.
+    The rows are ordered by grid point, then scenario.
+    """
+    dfs = []
+    for kwargs in scenarios:
+        df = config_dfs[config_key(kwargs)].copy()
+        if kwargs.get("scenario") is not None:
+            df["scenario"] = kwargs["scenario"]
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    return df.iloc[np.argsort(grid_index(df, param_dict), kind="stable")].reset_index(drop=True)
+
+# incremental runs: the configurations unaffected by the changes of the params file since the last run are read back
+# from the data files, instead of being calculated again
+def tech_sector(key):
+    """Returns the HTE sector of a tech (eg. "steel" for "ccs_steel"), or None for intermediate products."""
+    sector = key.split("_")[-1]
+    return sector if sector in Tech.SECTORS else None
+
+def affected_configs(changes, plans, param_dict, configs):
+    """
+    Returns the configurations (config key -> get_df kwargs) that can be affected by changes of the techs
+    (see tech_graph.diff_techs), with the affected sectors of each: dict config key -> set of sectors.
+    The techs depending on the changed ones are looked up in the plans of the last run and of the current params
+    file, so that the users of removed techs are counted too.
+    Changes of attributes that a configuration overrides (in its kwargs or grid) do not affect it.
+    """
+    affected = {}
+    for key, kwargs in configs.items():
+        overrides = set(kwargs) | set(param_dict)
+        changed = [tech for tech, attrs in changes.items() if any(f"{tech}_{attr}" not in overrides for attr in attrs)]
+        techs = set(changed).union(*(plan.downstream(changed) for plan in plans))
+        sectors = {tech_sector(tech) for tech in techs} - {None}
+        if sectors:
+            affected[key] = sectors
+    return affected
+
+def splice_sectors(previous_df, df, sectors, param_dict):
+    """
+    Returns the results of a configuration with the rows of the given sectors taken from df (calculated for these
+    sectors only, see process_tech_df.get_df_batch), and the rows of the other sectors from previous_df.
+    The rows are ordered by grid point, then sector, as get_df_batch orders them.
+    """
+    df = pd.concat([previous_df[~previous_df["sector"].isin(sectors)], df], ignore_index=True)
+    sector_codes = pd.Categorical(df["sector"], categories=sorted(df["sector"].unique())).codes
+    order = np.argsort(grid_index(df, param_dict) * len(Tech.SECTORS) + sector_codes, kind="stable")
+    return df.iloc[order].reset_index(drop=True)
+
+def family_configs(scenarios):
+    """Returns the configuration keys of the scenarios of a family."""
+    return {config_key(kwargs) for kwargs in scenarios}
+
+def family_run(scenarios, param_dict):
+    """Description of a family in the run log: its grid and the scenario names and configuration keys."""
+    return {
+        "grid": grid_key(param_dict),
+        "scenarios": [[kwargs.get("scenario"), config_key(kwargs)] for kwargs in scenarios],
+    }
 
+def read_previous_configs(file_name, run, param_dict, scenarios):
+    """
+    Reads the results of each configuration of a family back from its data file, given the family description
+    of the last run. Returns a dict: config key -> DataFrame, empty if the family (or its grid) changed since then.
+    """
+    file_path = Path(__file__).parent / 'data' / file_name
+    names = [scenario for scenario, _ in run["scenarios"]] if run is not None else []
+    if run != family_run(scenarios, param_dict) or len(set(names)) != len(names):
+        return {}
+
+    try:
+        df = rawdata.load_rawdata(file_path)
+    except FileNotFoundError:
+        return {}
+    if names == [None]:
+        return {run["scenarios"][0][1]: df}
+
+    # the columns after the scenario column are those of the scenarios after the first one (see assemble_family):
+    # each configuration only keeps those that it has values for, so that the columns come out in the same order
+    pos = df.columns.get_loc("scenario")
+    previous = {}
+    for scenario, key in run["scenarios"]:
+        df_scenario = df[df["scenario"] == scenario]
+        extra = df_scenario.iloc[:, pos + 1:]
+        cols = list(df.columns[:pos]) + list(extra.columns[extra.notna().any()])
+        previous[key] = df_scenario[cols].reset_index(drop=True)
+    return previous
+
+def load_last_run():
+    """Returns the log of the last run (see save_last_run), or None if it is missing or the code changed since."""
+    log_path = Path(__file__).parent / 'data' / 'lastrun.json'
+    if not log_path.exists():
+        return None
+    with open(log_path) as f:
+        last_run = json.load(f)
+    return last_run if last_run["code"] == result_cache.code_version() else None
+
+def save_last_run(families):
+    """Saves the params, code version and family descriptions of a run, next to its data files."""
+    with open(PATH_TO_PARAMS) as f:
+        data = json.load(f)
+    last_run = {
+        "code": result_cache.code_version(),
+        "techs": data["techs"],
+        "families": {name: family_run(scenarios(), params()[0]) for name, (_, params, scenarios) in families.items()},
+    }
+    data_dir = Path(__file__).parent / 'data'
+    data_dir.mkdir(exist_ok=True)
+    with open(data_dir / 'lastrun.json', "w") as f:
+        json.dump(last_run, f, default=list)
+
+def calc_families(pool, families, n_workers, last_run=None, fmt="csv", checkpoints=None):
+    """
+    Calculates the heat map data of all families, with the chunks of each grid spread over the pool, and saves it
+    in the data folder, in the format fmt (see rawdata.FORMATS).
+    Each distinct configuration is calculated once per grid point, and its results are shared by all the scenarios
+    (of any family) that declare it. The chunks are written to the data files as they are calculated (see
+    rawdata.RawdataWriter), so that the memory use does not grow with the size of the grids.
+    With the log of a previous run, only the configurations affected by the changes of the params file since then
+    are calculated, and only the families that contain them are saved. Of these configurations, only the rows of the
+    affected sectors are calculated, and spliced into the results of the last run (see splice_sectors), except with
+    CCU_coupling, which couples the sectors.
+    With checkpoints (see open_checkpoints), the calculated chunks are stored, so that an interrupted run can be resumed.
+    Returns the names of the saved families.
+    """
+    if last_run is not None:
+        with open(PATH_TO_PARAMS) as f:
+            changes = tech_graph.diff_techs(last_run["techs"], json.load(f)["techs"])
+        plans = [tech_graph.TechPlan(last_run["techs"]), tech_graph.load_plan(PATH_TO_PARAMS)]
+
+    data_dir = Path(__file__).parent / 'data'
+    data_dir.mkdir(exist_ok=True)
+
+    saved = []
+    for param_dict, names, configs in distinct_configs(families).values():
+        # the results of the last run, per family: a configuration shared by several families is read back from each
+        # of their files, as each file holds the columns of all its scenarios
+        previous_dfs = {name: {} for name in names}
+        partial = {}
+        stale = set(names)
+        if last_run is not None:
+            affected = affected_configs(changes, plans, param_dict, configs)
+            for name in names:
+                file_name, _, scenarios = families[name]
+                previous_dfs[name] = read_previous_configs(file_name, last_run["families"].get(name), param_dict, scenarios())
+                if previous_dfs[name] and rawdata.cube_path(Path(__file__).parent / 'data' / file_name).exists():
+                    stale.discard(name)
+            # the configurations in the results of the last run of all the families that declare them
+            reusable = {
+                key for key in configs.keys()
+                if all(key in previous_dfs[name] for name in names if key in family_configs(families[name][2]()))
+            }
+            # of these, the configurations whose unaffected sectors are read back from the last run
+            partial = {
+                key: sorted(sectors) for key, sectors in affected.items()
+                if key in reusable and len(sectors) < len(Tech.SECTORS) and not configs[key].get("CCU_coupling", False)
+            }
+            reusable = {key for key in reusable if key not in affected or key in partial}
+            previous_dfs = {
+                name: {key: df for key, df in dfs.items() if key in reusable} for name, dfs in previous_dfs.items()
+            }
+            sectors = sorted(set().union(*affected.values())) if affected else []
+            print(f"{', '.join(names)}: {len(configs) - len(reusable)} of {len(configs)} configurations to calculate, "
+                  f"{len(partial)} more for the affected sectors only (affected sectors: {', '.join(sectors) if sectors else 'none'})")
+
+        missing = {
+            key: {**kwargs, "sectors": partial[key]} if key in partial else kwargs
+            for key, kwargs in configs.items() if not any(key in dfs for dfs in previous_dfs.values()) or key in partial
+        }
+        to_save = [
+            name for name in names
+            if name in stale or any(config_key(kwargs) in missing for kwargs in families[name][2]())
+        ]
+        if not to_save:
+            continue
+
+        first_key = next(iter(param_dict))
+        with contextlib.ExitStack() as stack:
+            writers = {
+                name: stack.enter_context(rawdata.RawdataWriter(rawdata.with_format(data_dir / families[name][0], fmt)))
+                for name in to_save
+            }
+            # the data is also saved as dense cubes, for the plots (see rawdata.CubeWriter)
+            cube_writers = {
+                name: stack.enter_context(rawdata.CubeWriter(
+                    rawdata.cube_path(data_dir / families[name][0]),
+                    [kwargs.get("scenario") or "" for kwargs in families[name][2]()],
+                    Tech.SECTORS,
+                    param_dict,
+                ))
+                for name in to_save
+            }
+            for chunk, config_dfs in calc_configs(pool, param_dict, missing, chunk_count(param_dict, n_workers), checkpoints):
+                for name, writer in writers.items():
+                    # the rows of the chunk in the results of the last run
+                    family_dfs = dict(config_dfs)
+                    for key, df in previous_dfs[name].items():
+                        df = df[df[first_key].isin(chunk[first_key])].reset_index(drop=True)
+                        family_dfs[key] = splice_sectors(df, config_dfs[key], partial[key], chunk) if key in partial else df
+                    df = assemble_family(chunk, families[name][2](), family_dfs)
+                    writer.write(df)
+                    cube_writers[name].write(df)
+        saved.extend(to_save)
+
+    return saved
+
+# checkpoints: the results of each calculated chunk are stored until the end of the run, so that an interrupted run
+# can be resumed (see --resume) without calculating them again
+CHECKPOINT_DIR = Path(__file__).parent / 'data' / '.checkpoints'
+
+def open_checkpoints(n_workers, resume=False):
+    """
+    Returns the checkpoint store of a run (a ResultCache without size limit), and the number of workers its grids are
+    chunked for (see chunk_count).
+    The checkpoints of an interrupted run are only kept with resume, and if the params file and the code did not change
+    since that run: the checkpoint keys do not depend on them, so they are verified here, against the run description.
+    The chunks (and so the checkpoint keys) depend on the number of workers, so a resumed run chunks its grids for the
+    number of workers of the interrupted run, whatever its own.
+    """
+    checkpoints = result_cache.ResultCache(CHECKPOINT_DIR, max_size=sys.maxsize)
+    run_path = CHECKPOINT_DIR / 'run.json'
+    run = {"params": result_cache.params_fingerprint(PATH_TO_PARAMS), "code": result_cache.code_version()}
+
+    n_done = len(checkpoints.entries())
+    if resume and n_done and run_path.exists():
+        with open(run_path) as f:
+            previous_run = json.load(f)
+        chunk_workers = previous_run.pop("workers", n_workers)
+        if previous_run == run:
+            print(f"resuming the interrupted run: {n_done} chunks already calculated")
+            return checkpoints, chunk_workers
+        print("the params file or the code changed since the interrupted run, its checkpoints are discarded")
+
+    checkpoints.clear()
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(run_path, "w") as f:
+        json.dump({**run, "workers": n_workers}, f)
+    return checkpoints, n_workers
+
+def close_checkpoints(checkpoints):
+    """Removes the checkpoints, once the run is complete."""
+    checkpoints.clear()
+    (CHECKPOINT_DIR / 'run.json').unlink(missing_ok=True)
+
+# LCO breakdown cubes (optional): the cost contributions of the best tech of each sector, at every grid point
+def breakdown_file_name(file_name):
+    """Returns the name of the breakdown file of a family, eg. mainfig_breakdown.npz for mainfig_rawdata.csv."""
+    return file_name.replace("_rawdata.csv", "_breakdown.npz")
+
+def calc_breakdown_chunk(param_grid, configs):
+    """Calculates the breakdown cube (see process_tech_df.get_df_batch) of each configuration for a chunk of the grid."""
+    return [process_tech_df.get_df_batch(param_grid, as_cube=True, breakdown=True, **kwargs) for kwargs in configs]
+
+def calc_numbered_breakdown_chunk(task):
+    """calc_breakdown_chunk for a task (chunk number, chunk of the grid, configurations) of imap_unordered. Returns the chunk number too."""
+    idx, param_grid, configs = task
+    return idx, calc_breakdown_chunk(param_grid, configs)
+
+def calc_breakdowns(pool, param_dict, configs, n_chunks):
+    """
+    Calculates the breakdown cubes of configurations (config key -> get_df kwargs) over a grid, with the chunks
+    of the grid spread over the pool. Yields (index of the first grid point of the chunk, {config key: cube}) for each
+    chunk, as soon as it is done: the cubes of a chunk cover contiguous grid points (see split_grid).
+    """
+    chunks = split_grid(param_dict, n_chunks)
+    if not configs:
+        return
+    first_key = next(iter(param_dict))
+    line_size = int(np.prod([len(values) for key, values in param_dict.items() if key != first_key]))
+    offsets = np.cumsum([0] + [len(chunk[first_key]) * line_size for chunk in chunks])
+
+    tasks = [(idx, chunk, list(configs.values())) for idx, chunk in enumerate(chunks)]
+    for idx, cubes in pool.imap_unordered(calc_numbered_breakdown_chunk, tasks):
+        yield int(offsets[idx]), dict(zip(configs.keys(), cubes))
+
+class BreakdownWriter:
+    """
+    Writes the breakdown cube of a family to a .npz file, with the arrays:
+    - "scenarios", "sectors", "params": the names along each axis, and the values of each grid parameter (by name)
+    - "types": the tech types of each sector, shape (sectors, techs)
+    - "best": index of the best tech in "types" (-1 if there is none), shape (scenarios, *grid, sectors)
+    - "cost" and the contributions (h2, co2, co2ts, elec, capex) to the cost of the best tech, same shape
+
+    The chunks of the grid can be written in any order: they are placed in memory-mapped arrays, in a temporary
+    folder, and only compressed to path (replacing the previous file) when the writer is closed.
+    """
+
+    def __init__(self, path, scenarios, param_dict):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        self.scenarios = list(scenarios)
+        self.param_dict = param_dict
+        self.n_points = int(np.prod([len(values) for values in param_dict.values()]))
+        self.arrays = {}
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path.mkdir(parents=True)
+
+    def allocate(self, cube) -> None:
+        """Creates the arrays, with the sectors, tech types and contributions of a cube."""
+        n_sectors = len(cube["sectors"])
+        self.arrays = {
+            "scenarios": np.array([kwargs.get("scenario") or "" for kwargs in self.scenarios]),
+            "sectors": cube["sectors"].astype(str),
+            "params": np.array(list(self.param_dict.keys())),
+            **{key: np.asarray(values) for key, values in self.param_dict.items()},
+            "types": np.where(cube["types"] == None, "", cube["types"]).astype(str),
+        }
+        shape = (len(self.scenarios), self.n_points, n_sectors)
+        for name, dtype in [("best", np.int8), ("cost", np.float32), *[(name, np.float32) for name in cube["contributions"].keys()]]:
+            self.arrays[name] = np.lib.format.open_memmap(self.tmp_path / f"{name}.npy", mode="w+", dtype=dtype, shape=shape)
+
+    def write(self, offset, config_cubes) -> None:
+        """Places the cubes (config key -> cube) of a chunk of the grid, starting at the grid point offset."""
+        cubes = [config_cubes[config_key(kwargs)] for kwargs in self.scenarios]
+        if not self.arrays:
+            self.allocate(cubes[0])
+        for i, cube in enumerate(cubes):
+            rows = slice(offset, offset + len(cube["best"]))
+            self.arrays["best"][i, rows] = cube["best"]
+            self.arrays["cost"][i, rows] = cube["cost"]
+            for name, values in cube["contributions"].items():
+                self.arrays[name][i, rows] = values
+
+    def close(self) -> None:
+        """Compresses the arrays to path, in the shape (scenarios, *grid, sectors)."""
+        shape = [len(values) for values in self.param_dict.values()]
+        arrays = {
+            name: array.reshape(len(self.scenarios), *shape, array.shape[-1]) if isinstance(array, np.memmap) else array
+            for name, array in self.arrays.items()
+        }
+        np.savez_compressed(self.tmp_path / self.path.name, **arrays)
+        self.arrays = {}
+        os.replace(self.tmp_path / self.path.name, self.path)
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def abort(self) -> None:
+        """Removes the temporary arrays, leaving path unchanged."""
+        self.arrays = {}
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def calc_family_breakdowns(pool, families, names, n_workers):
+    """
+    Calculates the breakdown cubes of the given families, with the chunks of each grid spread over the pool, and saves
+    them in the data folder (see BreakdownWriter). As with calc_families, each distinct configuration is calculated
+    once, and the grids are chunked with chunk_count, so that only the chunks being calculated are held in memory.
+    """
+    data_dir = Path(__file__).parent / 'data'
+    data_dir.mkdir(exist_ok=True)
+    for param_dict, grid_names, configs in distinct_configs({name: families[name] for name in names}).values():
+        with contextlib.ExitStack() as stack:
+            writers = [
+                stack.enter_context(BreakdownWriter(data_dir / breakdown_file_name(families[name][0]), families[name][2](), param_dict))
+                for name in grid_names
+            ]
+            for offset, config_cubes in calc_breakdowns(pool, param_dict, configs, chunk_count(param_dict, n_workers)):
+                for writer in writers:
+                    writer.write(offset, config_cubes)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculates the data of all heat map figures, in the data folder.")
+    parser.add_argument("--workers", type=int, default=mp.cpu_count(), help="number of worker processes")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only recalculate the data affected by the changes of the params file since the last run")
+    parser.add_argument("--no-cache", action="store_true", help="recalculate everything, without reading or filling the result cache")
+    parser.add_argument("--cache-dir", default=result_cache.DEFAULT_CACHE_DIR, help="folder of the result cache")
+    parser.add_argument("--cache-size", default=result_cache.DEFAULT_MAX_SIZE, help='maximum size of the result cache (eg. "500MB")')
+    parser.add_argument("--resume", action="store_true",
+                        help="resume an interrupted run, without calculating its finished chunks again")
+    parser.add_argument("--format", choices=list(rawdata.FORMATS.keys()), default="csv",
+                        help="file format of the heat map data (npz and parquet are smaller and faster to load)")
+    parser.add_argument("--breakdown", action="store_true",
+                        help="also save the cost contributions (h2, co2, ...) of the best tech of each sector, at every grid point")
+    args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    # the families of scenarios (main figure, CO2 transport and storage sensitivity, retrofit sensitivity...) 
+    # share their common configurations. Each grid is split into contiguous chunks (at least one per worker),
+    # which are written to the data files as soon as they are done
+    families = hm_families()
+    checkpoints, chunk_workers = open_checkpoints(args.workers, resume=args.resume)
+    with mp.Pool(args.workers, initializer=init_worker, initargs=(PATH_TO_PARAMS, cache_dir, args.cache_size)) as pool:
+        last_run = load_last_run() if args.incremental else None
+        saved = calc_families(pool, families, n_workers=chunk_workers, last_run=last_run, fmt=args.format, checkpoints=checkpoints)
+
+        if args.breakdown:
+            # the breakdowns of unchanged families are only calculated if they are missing
+            names = [
+                name for name, (file_name, _, _) in families.items()
+                if name in saved or not (Path(__file__).parent / 'data' / breakdown_file_name(file_name)).exists()
+            ]
+            calc_family_breakdowns(pool, families, names, n_workers=chunk_workers)
+    if cache_dir is not None:
+        # each worker only counts the results it stored itself, so the shared cache is brought back under its limit
+        result_cache.ResultCache(cache_dir, args.cache_size).prune()
+
+    save_last_run(families)
+    close_checkpoints(checkpoints)